@@ -10,20 +10,51 @@ author: mbforbes
 
 # builtins
 import argparse
+import asyncio
+import atexit
 import code
-from email.mime.text import MIMEText
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum, auto
-import glob
+import json
+import multiprocessing
 import os
+import re
 import shutil
-from smtplib import SMTP_SSL as SMTP
-import subprocess as sp
+import struct
+import subprocess
 import sys
-from typing import List, Set, Tuple, Dict
+import time
+import traceback
+from typing import (
+    Any,
+    FrozenSet,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    TYPE_CHECKING,
+    Tuple,
+    Union,
+    Dict,
+)
+
+# email support is imported where it's used, since most runs only print
+if TYPE_CHECKING:
+    from smtplib import SMTP_SSL as SMTP
 
 # 3rd party
 from tqdm import tqdm
 
+# optional 3rd party: when installed, repositories are read in-process. pygit2
+# older than 1.14 (no pygit2.enums) may lack APIs the probe uses, like
+# status(untracked_files=...), so it's ignored and git is used instead.
+try:
+    import pygit2
+    import pygit2.enums
+except ImportError:
+    pygit2 = None  # type: ignore
+
 #
 # constants and utils
 #
@@ -34,6 +65,14 @@ class ReportOption(Enum):
     EMAIL = auto()
 
 
+# what probing a git repository found
+class GitStatus(NamedTuple):
+    dirty: bool
+    unpushed_branches: List[str]
+    # git couldn't read the repository, so the other fields mean nothing
+    unreadable: bool = False
+
+
 # map from externally-specified actions to set of things to do internally
 REPORT_TRANSLATION = {
     "print": {ReportOption.PRINT},
@@ -41,18 +80,92 @@ REPORT_TRANSLATION = {
     "both": {ReportOption.PRINT, ReportOption.EMAIL},
 }
 
+# connection shared by email reports (see smtp_conn)
+_smtp_conn: Optional["SMTP"] = None
+# recipient, sender username, and sender password (see email_config)
+_email_config: Optional[Tuple[str, str, str]] = None
+
 # cmd line defaults
 DEFAULT_CHECK_DIR = "~"
 DEFAULT_REPORT_CHOICE = "print"
 
-# how we actually check --- look for output strings! Lol.
-CLEAN_PHRASES = {"working directory clean", "working tree clean"}
+# how we actually check --- one shell per repo runs both git commands; their
+# outputs are split apart on PROBE_SEP. The repository is the script's first
+# argument and is handed to git with -C, so nothing has to change directory
+# before exec; the second is the --untracked-files mode. Discovery stops at the
+# repository's parent, so a broken .git fails instead of git quietly reading
+# an enclosing repository, and the script exits non-zero if either command
+# fails. fsmonitor is off so a sweep doesn't start a file system monitor daemon
+# for every repository it visits. The shell is named by absolute path so that,
+# with no cwd and no close_fds, Popen can start it with posix_spawn rather than
+# fork + exec.
+PROBE_SEP = "---"
+PROBE_SCRIPT = (
+    'export GIT_CEILING_DIRECTORIES="${{1%/*/}}"; '
+    'git -C "$1" -c core.fsmonitor=false status --porcelain=v2 --branch '
+    '--untracked-files="$2" || exit 1; echo {}; git -C "$1" for-each-ref '
+    "--format='%(refname:short)%09%(upstream:short)%09%(upstream:remotename)"
+    "%09%(upstream:track)' refs/heads || exit 1"
+).format(PROBE_SEP)
+PROBE_ARGS = (shutil.which("sh") or "/bin/sh", "-c", PROBE_SCRIPT, "git-checker")
+# the separator on a line of its own (status output always ends in a newline),
+# so a path ending in PROBE_SEP can't be mistaken for it
+PROBE_SEP_BYTES = b"\n" + PROBE_SEP.encode() + b"\n"
+# the remote of a branch whose upstream is another local branch
+LOCAL_REMOTE = b"."
+# unpushed commits on these branches are reported by directory alone
+DEFAULT_BRANCHES = {"master", "main"}
+# most git probes to have running at once by default; they mostly wait on
+# disk, so a few per CPU keeps it busy
+DEFAULT_JOBS = min(32, (os.cpu_count() or 1) * 4)
+# porcelain v2 header of a repository without commits
+UNBORN_HEADER = b"# branch.oid (initial)"
+# for-each-ref's "[ahead N]" is translated outside the C locale, and with
+# optional locks off, git status never rewrites the index (which would spoil
+# the cache's stamp)
+PROBE_ENV = {**os.environ, "LC_ALL": "C", "GIT_OPTIONAL_LOCKS": "0"}
+
+# prefix for each path listed in a report
+REPORT_BULLET = "\t - "
+
+# email config files live next to this script, wherever it's run from
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+RECIPIENT_PATH = os.path.join(SCRIPT_DIR, "recipient")
+SENDER_PATH = os.path.join(SCRIPT_DIR, "sender")
+# seconds to wait on the mail server before giving up, so a hung connection
+# can't stall a cron run forever
+SMTP_TIMEOUT = 15
+
+# where probe results for clean repositories are kept between runs
+CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", "~/.cache"), "git-checker", "status.json"
+)
+# files (under .git/) whose mtimes change whenever the index, HEAD, branches,
+# or upstream config do; every directory below STAMP_REF_DIRS is added too
+STAMP_FILES = ("index", "HEAD", "packed-refs", "config", "info/exclude")
+STAMP_REF_DIRS = ("refs/heads", "refs/remotes")
+# worktree changes this close before a probe may carry an older timestamp than
+# the probe itself (coarse filesystem clocks), so they invalidate its result
+RACY_NS = 2 * 10**9
+# most working tree directories the cache will stat to rule out new untracked
+# files; repositories with more are just probed again
+CACHE_MAX_DIRS = 5000
+
+# index entry types (mode >> 12) we can check: regular files and symlinks
+INDEX_FILE_TYPES = {0b1000, 0b1010}
+SHA256_RE = re.compile(rb"objectformat\s*=\s*sha256", re.IGNORECASE)
+
+# with --interval, polls back off (doubling, up to MAX_INTERVAL seconds) once
+# the report has come out the same BACKOFF_AFTER times in a row
+MAX_INTERVAL = 3600
+BACKOFF_AFTER = 3
+# where Linux lists power supplies; on battery when no "Mains" one is online
+POWER_SUPPLY_DIR = "/sys/class/power_supply"
 
 # dirs to never check
-IGNORE_DIRS = {"venv", ".cargo", ".pyenv"}
+IGNORE_DIRS = frozenset({"venv", ".cargo", ".pyenv", "node_modules"})
 
 # checking for other stuff in your home directory
-HOME_PATTERN = "~/*"
 HOME_NOLOOK = [
     "Applications",  # clean this up on your own time some time
     "GoogleDrive",  # stuff here be backed up
@@ -61,15 +174,17 @@ HOME_NOLOOK = [
     "Tendershoot",  # Hypnospace Outlaw. (Really should have per-user config...)
 ]
 # mapping from things we want to look in to exceptions for what can be there
-HOME_LOOK: Dict[str, Set[str]] = {
-    "Desktop": set(),
-    "Documents": set(),
-    "Downloads": set(),
-    "Movies": set(),
-    "Music": {"Audio Music Apps", "iTunes"},
-    "Pictures": {"Photo Booth Library", "Photos Library.photoslibrary"},
-    "Public": set(),
+HOME_LOOK: Dict[str, FrozenSet[str]] = {
+    "Desktop": frozenset(),
+    "Documents": frozenset(),
+    "Downloads": frozenset(),
+    "Movies": frozenset(),
+    "Music": frozenset({"Audio Music Apps", "iTunes"}),
+    "Pictures": frozenset({"Photo Booth Library", "Photos Library.photoslibrary"}),
+    "Public": frozenset(),
 }
+# everything allowed at the top level of your home directory
+HOME_OK_TOPS = frozenset(HOME_NOLOOK) | frozenset(HOME_LOOK)
 
 # Thanks to Brant Faircloth (https://gist.github.com/brantfaircloth/1443543)
 # for some of these nice argparse utils.
@@ -97,6 +212,20 @@ def ensure_dir(path: str) -> str:
     return path
 
 
+def positive_int(raw: str) -> int:
+    """Parses a positive integer.
+
+    Raises ArgumentTypeError if the validation fails.
+    """
+    try:
+        value = int(raw)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError("{0} is not a positive integer".format(raw))
+    return value
+
+
 #
 # main functionality
 #
@@ -104,36 +233,35 @@ def ensure_dir(path: str) -> str:
 
 def home_checker(prompt: bool = True) -> str:
     """TODO: make this method configurable."""
-    report = []
+    problems = []
     cleanup_list = []
 
     # check top level
-    tops = glob.glob(full_path(HOME_PATTERN))
-    ok_tops = set(HOME_NOLOOK + list(HOME_LOOK.keys()))
-    for top in tops:
-        short_top = os.path.basename(top)
-        if short_top not in ok_tops:
-            report.append('- ~/ has unwanted top-level contents "{}"'.format(top))
-            cleanup_list.append(top)
+    home = full_path("~")
+    for top in list_visible(home):
+        if top.name not in HOME_OK_TOPS:
+            problems.append(
+                '- ~/ has unwanted top-level contents "{}"'.format(top.path)
+            )
+            cleanup_list.append(top.path)
 
     # for ones where we want to look, make sure they're empty
     for dirname, allowed in HOME_LOOK.items():
-        contents = glob.glob(full_path(os.path.join("~", dirname, "*")))
-        for c in contents:
-            short_c = os.path.basename(c)
-            if short_c not in allowed:
-                report.append(
-                    '- ~/{} has unwanted contents "{}"'.format(dirname, short_c)
+        for c in list_visible(os.path.join(home, dirname)):
+            if c.name not in allowed:
+                problems.append(
+                    '- ~/{} has unwanted contents "{}"'.format(dirname, c.name)
                 )
-                cleanup_list.append(c)
+                cleanup_list.append(c.path)
 
-    # prepend home checker report summary
-    clean = len(report) == 0
-    report.insert(0, "[home-checker]")
+    # put the home checker report summary in front of the problems
+    clean = len(problems) == 0
+    report = ["[home-checker]"]
     if clean:
         report.append("Home checker succeeded. Home directory clean!")
     else:
-        report.insert(1, "Home checker found {} problems:".format(len(report)))
+        report.append("Home checker found {} problems:".format(len(problems)))
+        report.extend(problems)
 
     # maybe auto-cleanup
     if not clean and prompt:
@@ -165,134 +293,322 @@ def home_checker(prompt: bool = True) -> str:
 
 
 def git_checker(
-    check_dir: str, report_choices: Set[ReportOption]
-) -> Tuple[str, int, int]:
-    """The git part of the checking."""
-    # Save original path (gets messed up and unreachable after changing
-    # directories a bunch and reading files, I guess...)
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-
-    # Write checked dir before expanding.
-    report = '- Checked at and below "{}"\n'.format(check_dir)
+    check_dir: str,
+    report_choices: Set[ReportOption],
+    jobs: int = DEFAULT_JOBS,
+    use_cache: bool = True,
+    untracked: bool = True,
+) -> Tuple[str, int, int, int]:
+    """
+    The git part of the checking. Returns the report, and the numbers of dirty
+    directories, unpushed branches, and repositories git couldn't read.
+    """
+    cache = load_cache() if use_cache else None
 
-    # Get the void.
-    dn = open(os.devnull, "w")
+    # Report lines, joined once at the end. Write checked dir before expanding.
+    lines = ['- Checked at and below "{}"'.format(check_dir)]
 
     # Check.
+    progress = None
     if ReportOption.PRINT in report_choices:
         print(
-            '[git-checker]\nFinding all git directories at/below "{}"...'.format(
+            "[git-checker]\n"
+            'Finding and checking all git directories at/below "{}"...'.format(
                 check_dir
             )
         )
-    p = sp.Popen(
-        [
-            "find",  # command
-            check_dir,  # directory to look in (default: home)
-            "-name",  # search by name
-            ".git",
-            "-type",  # specify type
-            "d",
-        ],  # the name we want
-        stdout=sp.PIPE,  # catch output
-        stderr=dn,  # send errors to the void!
-        universal_newlines=True,  # so we get a str out instead of bytes
-    )
-    res, err = p.communicate()
-
-    # close the void
-    dn.close()
-
-    # Filter out crap and peel off .git endings.
-    all_git_dirs = [r.split(".git")[0] for r in res.splitlines() if r.endswith("git")]
-    git_dirs = [d for d in all_git_dirs if not exclude(d)]
-    report += "- Found {} git {}.\n".format(
-        len(git_dirs), ("repository" if len(git_dirs) == 1 else "repositories")
+        progress = tqdm(total=0)
+    results = asyncio.run(find_and_probe(check_dir, progress, cache, jobs, untracked))
+    if progress is not None:
+        progress.close()
+    if cache is not None:
+        # Forget repositories that were under check_dir but are gone now.
+        found = {gd for gd, _ in results}
+        prefix = os.path.join(check_dir, "")
+        for gd in list(cache):
+            if gd.startswith(prefix) and gd not in found:
+                del cache[gd]
+        save_cache(cache)
+    lines.append(
+        "- Found {} git {}.".format(
+            len(results), ("repository" if len(results) == 1 else "repositories")
+        )
     )
 
-    # Use progress bar only if printing
-    itr = git_dirs
-    if ReportOption.PRINT in report_choices:
-        print("Checking status of all {} directories...".format(len(git_dirs)))
-        itr = tqdm(git_dirs)
-
     # Try to find dirty working directories, or unpushed branches.
     dirty_dirs: List[str] = []
     unpushed_branches: List[str] = []
-    for gd in itr:
-        report_if_dirty(gd, dirty_dirs)
-        report_if_unpushed(gd, unpushed_branches)
+    unreadable_dirs: List[str] = []
+    for gd, status in results:
+        if status.unreadable:
+            unreadable_dirs.append(gd)
+        if status.dirty:
+            dirty_dirs.append(gd)
+        unpushed_branches.extend(status.unpushed_branches)
+
+    # Probes finish in any order, so sort for a stable report.
+    dirty_dirs.sort()
+    unpushed_branches.sort()
+    unreadable_dirs.sort()
 
     # Make a space in the message body.
-    report += "\n"
+    lines.append("")
+
+    # Append each kind of problem found, with two blank lines between kinds.
+    sections = [
+        ("The following directories ({}) have dirty WDs:", dirty_dirs),
+        (
+            "The following directories (+branches) ({}) need to be pushed:",
+            unpushed_branches,
+        ),
+        ("The following directories ({}) could not be checked:", unreadable_dirs),
+    ]
+    clean = True
+    for header, entries in sections:
+        if len(entries) == 0:
+            continue
+        if not clean:
+            lines.extend(["", ""])
+        clean = False
+        lines.append(header.format(len(entries)))
+        lines.extend(REPORT_BULLET + e for e in entries)
+    if clean:
+        # Alternate message if everything good (printed only).
+        lines.append("All git repositories checked were clean.")
+
+    # Trailing newline.
+    lines.append("")
+    return (
+        "\n".join(lines),
+        len(dirty_dirs),
+        len(unpushed_branches),
+        len(unreadable_dirs),
+    )
 
-    # Append any dirty directories.
-    if len(dirty_dirs) > 0:
-        report += "The following directories ({}) have dirty WDs:\n{}".format(
-            len(dirty_dirs), reportify(dirty_dirs)
-        )
-    if len(dirty_dirs) > 0 and len(unpushed_branches) > 0:
-        report += "\n\n"
-    if len(unpushed_branches) > 0:
-        report += (
-            "The following directories (+branches) ({}) need to be pushed:\n{}".format(
-                len(unpushed_branches), reportify(unpushed_branches)
+
+async def find_and_probe(
+    check_dir: str,
+    progress: Optional[tqdm] = None,
+    cache: Optional[Dict[str, Dict[str, Any]]] = None,
+    jobs: int = DEFAULT_JOBS,
+    untracked: bool = True,
+) -> List[Tuple[str, GitStatus]]:
+    """
+    Find all git directories at/below `check_dir` and probe each one as soon as
+    it's found, with at most `jobs` probes running at once. With pygit2,
+    probes run in a process pool, since libgit2 calls hold the GIL. Untracked
+    files only make a repository dirty if `untracked` is set.
+
+    If a `cache` (see load_cache) is given, repositories it shows as unchanged
+    since they were last probed clean are not probed again, and the cache is
+    updated with the new results.
+
+    Returns (directory, probe result) pairs in the order the probes finished.
+    """
+    sem = asyncio.Semaphore(jobs)
+    loop = asyncio.get_running_loop()
+    pool = None
+    if pygit2 is not None:
+        # Workers are spawned fresh rather than forked from this (threaded)
+        # process, and only ever get passed a directory name.
+        pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+
+    results: List[Tuple[str, GitStatus]] = []
+
+    async def probe(gd: str) -> None:
+        # A handful of stats under .git/ rule out most stale cache entries
+        # before anything heavier runs.
+        stamp = repo_stamp(gd)
+        entry = cache.get(gd) if cache is not None else None
+        result = None
+        # Clean with untracked files counted is clean without, but not the
+        # other way around.
+        if (
+            entry is not None
+            and entry["stamp"] == stamp
+            and (entry.get("untracked", True) or not untracked)
+        ):
+            # Checking the working directory stats every tracked file, so keep
+            # it off the event loop.
+            result = await loop.run_in_executor(
+                None, cached_probe, gd, entry, untracked
             )
-        )
-    if len(dirty_dirs) == 0 and len(unpushed_branches) == 0:
-        # Alternate message if everything good (printed only).
-        report += "All git repositories checked were clean.\n"
+        if result is None:
+            checked_at = time.time_ns()
+            async with sem:
+                result = None
+                if pygit2 is not None:
+                    result = await loop.run_in_executor(
+                        pool, probe_repo_pygit2, gd, untracked
+                    )
+                if result is None:
+                    result = await probe_repo(gd, untracked)
+            if cache is not None:
+                # Only a probe that succeeded and found nothing is remembered.
+                if result.dirty or result.unreadable:
+                    cache.pop(gd, None)
+                else:
+                    cache[gd] = {
+                        "stamp": stamp,
+                        "checked_at": checked_at,
+                        "unpushed": result.unpushed_branches,
+                        "untracked": untracked,
+                    }
+        results.append((gd, result))
+        if progress is not None:
+            progress.update()
+
+    # Walk in a worker thread, starting a probe for each repository as soon as
+    # it's found.
+    tasks = []
+
+    def found(gd: str) -> None:
+        tasks.append(asyncio.ensure_future(probe(gd)))
+        if progress is not None:
+            progress.total += 1
+
+    def walk() -> None:
+        for gd in find_git_dirs(check_dir):
+            loop.call_soon_threadsafe(found, gd)
 
-    return report, len(dirty_dirs), len(unpushed_branches)
+    try:
+        await loop.run_in_executor(None, walk)
+        await asyncio.gather(*tasks)
+        return results
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
 
-def report_if_dirty(gd: str, dirty_dirs: List[str]):
+def find_git_dirs(root: str) -> Iterator[str]:
     """
-    Check if the git repository at `gd` is dirty. If any dirty repository is found, it
-    is added to `dirty_dirs`.
+    Yields every directory at/below `root` that has a .git directory, as a path
+    ending in a separator. Never descends into .git directories, symlinks, or
+    IGNORE_DIRS, and skips directories it can't read.
     """
-    p = sp.Popen(["git", "status"], stdout=sp.PIPE, universal_newlines=True, cwd=gd)
-    res, ess = p.communicate()
-    # Find what's important.
-    lines = res.splitlines()
-    if not check_clean(lines):
-        # WD dirty
-        dirty_dirs += [gd]
-
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                # DirEntry caches the type from readdir, so this is no extra stat.
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if entry.name == ".git":
+                    yield os.path.join(d, "")
+                elif entry.name not in IGNORE_DIRS:
+                    stack.append(entry.path)
+
+
+async def probe_repo(gd: str, untracked: bool = True) -> GitStatus:
+    """
+    Check the git repository at `gd` for a dirty working directory and for local
+    branches that are ahead of their upstream, using a single subprocess.
+    Untracked files only count as dirty if `untracked` is set.
 
-def report_if_unpushed(gd: str, unpushed_branches: List[str]):
+    Returns whether the repository is dirty, and the report entries for any
+    unpushed branches (see unpushed_entry), or that it's unreadable if git
+    failed.
     """
-    Check if the git repository at `gd` has unpushed branches with a remote. If
-    any unpushed branch is found, it is added to `unpushed_branches`.
+    p = await asyncio.create_subprocess_exec(
+        *PROBE_ARGS,
+        gd,
+        "normal" if untracked else "no",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        env=PROBE_ENV,
+        # Our own fds are all non-inheritable anyway.
+        close_fds=False,
+    )
+    # Output is parsed as bytes; only branch names that get reported are decoded.
+    res, _ = await p.communicate()
+    if p.returncode != 0:
+        return GitStatus(False, [], unreadable=True)
+    status, _, refs = res.partition(PROBE_SEP_BYTES)
+
+    # Any line besides the `#` headers is a change (1/2: changed, u: unmerged,
+    # ?: untracked). A repository with no commits yet counts as dirty, too.
+    status_lines = status.splitlines()
+    dirty = any(not line.startswith(b"#") for line in status_lines) or (
+        UNBORN_HEADER in status_lines
+    )
+
+    # Each line is "<branch>\t<upstream>\t<remote>\t<track>", where track looks
+    # like "[ahead 1, behind 2]" (or is empty when up to date / no upstream).
+    # Branches whose upstream is another local branch (remote ".") have
+    # nothing to push.
+    unpushed = []
+    for line in refs.splitlines():
+        fields = line.split(b"\t")
+        if len(fields) != 4:
+            continue
+        branch, _, remote, track = fields
+        if remote != LOCAL_REMOTE and b"ahead" in track:
+            unpushed.append(unpushed_entry(gd, os.fsdecode(branch)))
+
+    return GitStatus(dirty, unpushed)
+
+
+def probe_repo_pygit2(gd: str, untracked: bool = True) -> Optional[GitStatus]:
     """
-    # Retrieve all branches with a configured remote
-    branches_with_remote = ["git", "config", "--get-regexp", "^branch\..*\.remote$"]
-    p = sp.Popen(branches_with_remote, stdout=sp.PIPE, universal_newlines=True, cwd=gd)
-    res, ess = p.communicate()
-    branches_with_remotes = [
-        (r.split(".")[1], r.split(" ")[1]) for r in res.splitlines()
-    ]
+    Like probe_repo, but reads the repository in-process with pygit2 (libgit2)
+    instead of starting a git subprocess.
 
-    # Check each branch with a remote which is not pushed
-    for (branch, remote) in branches_with_remotes:
-        # Check which commits are on branch, but not on remote/branch
-        query = f"{remote}/{branch}..{branch}"
-        p = sp.Popen(
-            ["git", "log", query], stdout=sp.PIPE, universal_newlines=True, cwd=gd
-        )
-        res, ess = p.communicate()
-        # Find what's important.
-        if res != "":
-            # Changes unpushed
-            if branch == "master":
-                unpushed_branches += [gd]
-            else:
-                unpushed_branches += [f"{gd}, branch {branch}"]
+    Returns None if libgit2 can't read the repository, so the caller can fall
+    back to probe_repo. (This runs in a worker process, and pygit2's errors
+    can't be pickled back to the caller.)
+    """
+    try:
+        # Like GIT_CEILING_DIRECTORIES in PROBE_SCRIPT: a broken .git is an error,
+        # not a reason to look for an enclosing repository.
+        repo = pygit2.Repository(gd, pygit2.enums.RepositoryOpenFlag.NO_SEARCH)
+        status = repo.status(untracked_files="normal" if untracked else "no")
+        dirty = repo.head_is_unborn or len(status) > 0
+
+        unpushed = []
+        for name in repo.branches.local:
+            branch = repo.branches.local[name]
+            upstream = branch.upstream
+            if upstream is None:
+                continue
+            remote_key = "branch.{}.remote".format(name)
+            if (
+                remote_key in repo.config
+                and repo.config[remote_key] == LOCAL_REMOTE.decode()
+            ):
+                continue
+            ahead, _ = repo.ahead_behind(branch.target, upstream.target)
+            if ahead > 0:
+                unpushed.append(unpushed_entry(gd, name))
+    except (pygit2.GitError, UnicodeError):
+        # libgit2 can't read it, or pygit2 can't look up a ref whose name isn't
+        # UTF-8; probe_repo handles both.
+        return None
+
+    return GitStatus(dirty, unpushed)
+
+
+def unpushed_entry(gd: str, branch: str) -> str:
+    """Makes the report entry for `branch` of `gd` being unpushed."""
+    if branch in DEFAULT_BRANCHES:
+        return gd
+    return f"{gd}, branch {branch}"
 
 
 def checker(
-    git_check_dir: str, report_choices: Set[ReportOption], check_home: bool
-) -> None:
+    git_check_dir: str,
+    report_choices: Set[ReportOption],
+    check_home: bool,
+    jobs: int = DEFAULT_JOBS,
+    use_cache: bool = True,
+    untracked: bool = True,
+    interactive: bool = True,
+    previous: Optional[str] = None,
+) -> str:
     """
     Check git directories for uncommited files and unpushed commits. Maybe check
     home directories for unwanted files. Report status to user either via stdout
@@ -302,52 +618,339 @@ def checker(
         - git_check_dir: Root of directories to check.
         - report_choices: What types of reporting to do.
         - check_home: Whether to crawl home directory and check for files.
+        - jobs: Most repositories to check at once.
+        - use_cache: Whether to reuse (and save) results for unchanged repos.
+        - untracked: Whether untracked files make a working directory dirty.
+        - interactive: Whether the home checker may offer to clean up.
+        - previous: The last report made (when polling); it isn't emailed again.
+
+    Returns the report.
     """
-    git_report, n_dirty, n_unpushed = git_checker(git_check_dir, report_choices)
-    home_report = "\n" + home_checker() if check_home else ""
+    git_report, n_dirty, n_unpushed, n_unreadable = git_checker(
+        git_check_dir, report_choices, jobs, use_cache, untracked
+    )
+    home_report = "\n" + home_checker(interactive) if check_home else ""
 
     report = git_report + home_report
+    # Paths and branch names that aren't UTF-8 were decoded with surrogate
+    # escapes; show their odd bytes as \xNN so the report can be printed and
+    # emailed.
+    report = report.encode(errors="surrogateescape").decode(errors="backslashreplace")
 
     # It's not useful unless you tell someone about it!
     if ReportOption.PRINT in report_choices:
         # For a printed report, we spit out even if nothing dirty.
         print(report)
-    if ReportOption.EMAIL in report_choices and (n_dirty > 0 or n_unpushed > 0):
-        # For an email report, we only send if something's dirty or unpushed to
-        # avoid spam.
-        email_report(report, n_dirty, n_unpushed)
+    if (
+        ReportOption.EMAIL in report_choices
+        and (n_dirty > 0 or n_unpushed > 0 or n_unreadable > 0)
+        and report != previous
+    ):
+        # For an email report, we only send if something's dirty, unpushed, or
+        # unreadable (and it's news) to avoid spam.
+        email_report(report, n_dirty, n_unpushed, n_unreadable)
+    return report
+
+
+def daemon_loop(
+    git_check_dir: str,
+    report_choices: Set[ReportOption],
+    check_home: bool,
+    base_interval: int,
+    jobs: int = DEFAULT_JOBS,
+    use_cache: bool = True,
+    untracked: bool = True,
+) -> None:
+    """
+    Runs checker() every `base_interval` seconds until interrupted.
+
+    Once the report stops changing, polls back off (see BACKOFF_AFTER) up to
+    MAX_INTERVAL, and any change brings them back to `base_interval`. Polls are
+    skipped while the machine is busy or on battery. A poll that fails (e.g. the
+    email can't be sent) is logged and retried after `base_interval`.
+    """
+    interval = base_interval
+    last_report = None
+    # how many polls in a row have made the same report as this one
+    same_in_a_row = 0
+    while True:
+        if not machine_busy():
+            try:
+                report = checker(
+                    git_check_dir,
+                    report_choices,
+                    check_home,
+                    jobs,
+                    use_cache,
+                    untracked,
+                    interactive=False,
+                    previous=last_report,
+                )
+            except Exception:
+                # last_report isn't advanced, so an email that didn't go out is
+                # sent by the next poll that succeeds.
+                print(
+                    "git-checker: check failed, retrying in {}s:".format(base_interval),
+                    file=sys.stderr,
+                )
+                traceback.print_exc()
+                # Don't reuse a mail connection that may be broken.
+                flush_email()
+                same_in_a_row = 0
+                interval = base_interval
+                time.sleep(interval)
+                continue
+            if report == last_report:
+                same_in_a_row += 1
+                if same_in_a_row >= BACKOFF_AFTER:
+                    interval = min(interval * 2, max(MAX_INTERVAL, base_interval))
+            else:
+                same_in_a_row = 1
+                interval = base_interval
+            last_report = report
+        time.sleep(interval)
 
 
-def exclude(path: str, ignore_list: Set[str] = IGNORE_DIRS) -> bool:
-    """Returns whether path should be excluded because any part of it appears in
-    the ignore_list.
+def machine_busy() -> bool:
     """
-    for piece in os.path.normpath(path).split(os.sep):
-        if piece in ignore_list:
+    Returns whether a background poll should wait: the load average is above the
+    number of CPUs, or the machine is running on battery.
+    """
+    try:
+        if os.getloadavg()[0] > (os.cpu_count() or 1):
             return True
-    return False
+    except (AttributeError, OSError):
+        # No load average on this platform.
+        pass
+    return on_battery()
+
+
+def on_battery() -> bool:
+    """Returns whether the machine is known to be running on battery."""
+    if sys.platform == "darwin":
+        try:
+            res = subprocess.run(
+                ["pmset", "-g", "ps"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ).stdout
+        except OSError:
+            return False
+        return b"'Battery Power'" in res
+    mains = []
+    for supply in list_visible(POWER_SUPPLY_DIR):
+        try:
+            with open(os.path.join(supply.path, "type")) as f:
+                if f.read().strip() != "Mains":
+                    continue
+            with open(os.path.join(supply.path, "online")) as f:
+                mains.append(f.read().strip() == "1")
+        except OSError:
+            continue
+    # Desktops and containers often list no mains supply at all.
+    return len(mains) > 0 and not any(mains)
+
+
+def list_visible(path: str) -> List[os.DirEntry]:
+    """
+    Returns the entries of directory `path` that don't start with a "." (like
+    glob's "*"), or an empty list if it can't be read.
+    """
+    try:
+        with os.scandir(path) as it:
+            return [entry for entry in it if not entry.name.startswith(".")]
+    except OSError:
+        return []
+
+
+def load_cache() -> Dict[str, Dict[str, Any]]:
+    """
+    Loads saved probe results, keyed by git directory. Each entry holds the
+    repo_stamp() and time from just before a probe that found the working
+    directory clean, and the unpushed branches it found.
+    """
+    try:
+        with open(full_path(CACHE_PATH)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 
-def reportify(paths: List[str]) -> str:
-    """Makes a nice string for a list of paths."""
-    return "\n".join(["\t - {}".format(p) for p in paths]) + "\n"
+def save_cache(cache: Dict[str, Dict[str, Any]]) -> None:
+    """Saves probe results for the next run (see load_cache)."""
+    path = full_path(CACHE_PATH)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
 
 
-def check_clean(status: List[str]) -> bool:
+def cached_probe(
+    gd: str, entry: Dict[str, Any], untracked: bool = True
+) -> Optional[GitStatus]:
     """
-    Returns whether a status string indicates that a working directory is clean.
+    Returns the cached probe result for the git repository at `gd` if its
+    working directory hasn't been touched since, or None if it must be probed.
+    The caller must already have matched the entry's repo_stamp().
+
+    Every tracked file and every directory above one must be older than the
+    cached probe: edits change a file's mtime/ctime, and creating or deleting
+    files changes their directory's. If `untracked` files count, so must every
+    other directory in the working tree, since a new untracked file can land
+    in one that holds no tracked files (only ignored ones, or nothing).
+    """
+    paths = index_paths(gd)
+    if paths is None:
+        return None
+    since = entry["checked_at"] - RACY_NS
+    dirs = {""}
+    try:
+        for path in paths:
+            st = os.lstat(os.path.join(gd, path))
+            if st.st_mtime_ns >= since or st.st_ctime_ns >= since:
+                return None
+            parent = os.path.dirname(path)
+            while parent not in dirs:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        if untracked:
+            all_dirs = worktree_dirs(gd)
+            if all_dirs is None:
+                return None
+            dirs.update(all_dirs)
+        for d in dirs:
+            st = os.lstat(os.path.join(gd, d))
+            if st.st_mtime_ns >= since or st.st_ctime_ns >= since:
+                return None
+    except OSError:
+        return None
+    return GitStatus(False, entry["unpushed"])
+
+
+def worktree_dirs(gd: str) -> Optional[List[str]]:
+    """
+    Returns every directory in the working tree of the repository at `gd`,
+    relative to it ("" for the top), without descending into .git directories
+    or symlinks. Returns None if there are more than CACHE_MAX_DIRS.
 
-    Args:
-        status: Output of `git status`
+    Raises OSError if a directory can't be read.
     """
-    last_line = status[-1]
-    for clean_end in CLEAN_PHRASES:
-        if clean_end in last_line:
-            return True
-    return False
+    found = [""]
+    stack = [""]
+    while stack:
+        d = stack.pop()
+        with os.scandir(os.path.join(gd, d)) as it:
+            for entry in it:
+                if entry.name == ".git" or not entry.is_dir(follow_symlinks=False):
+                    continue
+                sub = os.path.join(d, entry.name)
+                found.append(sub)
+                if len(found) > CACHE_MAX_DIRS:
+                    return None
+                stack.append(sub)
+    return found
+
+
+def repo_stamp(gd: str) -> Dict[str, Union[int, str, None]]:
+    """
+    Returns the mtimes of the files in `gd`'s .git directory that decide what
+    a probe reports besides the working directory itself (see STAMP_FILES),
+    plus what HEAD points to, in case it changed within the mtime resolution.
+    """
+    git_dir = os.path.join(gd, ".git")
+    paths = [os.path.join(git_dir, name) for name in STAMP_FILES]
+    for ref_dir in STAMP_REF_DIRS:
+        # Updating a loose ref renames a new file over it, which changes the
+        # mtime of its directory.
+        paths.extend(
+            dirpath for dirpath, _, _ in os.walk(os.path.join(git_dir, ref_dir))
+        )
+    stamp: Dict[str, Union[int, str, None]] = {}
+    for path in paths:
+        try:
+            stamp[os.path.relpath(path, git_dir)] = os.stat(path).st_mtime_ns
+        except OSError:
+            stamp[os.path.relpath(path, git_dir)] = None
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            stamp["HEAD contents"] = f.read()
+    except OSError:
+        stamp["HEAD contents"] = None
+    return stamp
 
 
-def email_report(report: str, n_dirty: int, n_unpushed: int) -> None:
+def index_paths(gd: str) -> Optional[List[str]]:
+    """
+    Returns the paths of all files in the index of the git repository at `gd`,
+    or None if the index is missing or uses a feature we don't read (SHA-256,
+    submodules, sparse directories, split index).
+
+    See https://git-scm.com/docs/index-format for the format.
+    """
+    git_dir = os.path.join(gd, ".git")
+    try:
+        with open(os.path.join(git_dir, "config"), "rb") as f:
+            if SHA256_RE.search(f.read()):
+                return None
+        with open(os.path.join(git_dir, "index"), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if data[:4] != b"DIRC":
+        return None
+    version, n_entries = struct.unpack(">II", data[4:12])
+    if version not in (2, 3, 4):
+        return None
+
+    paths = []
+    path = b""
+    off = 12
+    for _ in range(n_entries):
+        # Entries start with 40 bytes of stat info (mode at 24), a 20 byte
+        # object name, and 2 bytes of flags, then an extra 2 bytes of flags if
+        # the extended bit is set.
+        (mode,) = struct.unpack(">I", data[off + 24 : off + 28])
+        (flags,) = struct.unpack(">H", data[off + 60 : off + 62])
+        if mode >> 12 not in INDEX_FILE_TYPES:
+            return None
+        start = off + 62 + (2 if flags & 0x4000 else 0)
+        if version == 4:
+            # The path is the previous one minus `strip` bytes, plus the rest.
+            c = data[start]
+            strip = c & 0x7F
+            while c & 0x80:
+                start += 1
+                c = data[start]
+                strip = ((strip + 1) << 7) | (c & 0x7F)
+            start += 1
+            end = data.index(b"\0", start)
+            path = path[: len(path) - strip] + data[start:end]
+            off = end + 1
+        else:
+            # Entries are NUL-padded to a multiple of 8 bytes.
+            end = data.index(b"\0", start)
+            path = data[start:end]
+            off += (end - off + 8) & ~7
+        paths.append(os.fsdecode(path))
+
+    # A split index only holds changes on top of a shared index file.
+    while off + 8 <= len(data) - 20:
+        signature = data[off : off + 4]
+        (size,) = struct.unpack(">I", data[off + 4 : off + 8])
+        if signature == b"link":
+            return None
+        off += 8 + size
+    return paths
+
+
+def email_report(
+    report: str,
+    n_dirty: int,
+    n_unpushed: int,
+    n_unreadable: int = 0,
+    conn: Optional["SMTP"] = None,
+) -> None:
     """
     Send email report to address in the "recipient" file using the userame and
     password in the "sender" file.
@@ -356,33 +959,83 @@ def email_report(report: str, n_dirty: int, n_unpushed: int) -> None:
         report (str) The report
         n_dirty (int) The number of dirty directories
         n_unpushed (int) The number of unpushed directories
+        n_unreadable (int, optional) The number of repositories git couldn't read
+        conn (SMTP, optional) Logged-in connection to send with. By default, a
+            connection is opened on first use and reused until exit.
     """
-    # Who to send report to.
-    with open("recipient") as recipient:
-        user_email = recipient.read().strip()
+    from email.mime.text import MIMEText
+    from smtplib import SMTPServerDisconnected
 
-    # Account from which to send the email.
-    with open("sender") as sender:
-        sender_uname, sender_psswd = sender.read().strip().split("\n")
+    # Who to send report to, and the account from which to send it.
+    user_email, sender_uname, sender_psswd = email_config()
 
     # Convert format.
     msg = MIMEText(report)
 
     # Set email fields.
     receiver = user_email
-    msg["Subject"] = "git-checker report: {} dirty, {} unpushed".format(
-        n_dirty, n_unpushed
-    )
+    subject = "git-checker report: {} dirty, {} unpushed".format(n_dirty, n_unpushed)
+    if n_unreadable > 0:
+        subject += ", {} unreadable".format(n_unreadable)
+    msg["Subject"] = subject
     msg["From"] = sender_uname
     msg["To"] = receiver
 
-    # Login and send email.
-    conn = SMTP("smtp.gmail.com")
-    conn.login(sender_uname, sender_psswd)
-    try:
+    # Login (if needed) and send email.
+    if conn is not None:
         conn.sendmail(sender_uname, receiver, msg.as_string())
-    finally:
-        conn.close()
+        return
+    try:
+        smtp_conn(sender_uname, sender_psswd).sendmail(
+            sender_uname, receiver, msg.as_string()
+        )
+    except SMTPServerDisconnected:
+        # The server may have dropped an idle session; log in again once.
+        flush_email()
+        smtp_conn(sender_uname, sender_psswd).sendmail(
+            sender_uname, receiver, msg.as_string()
+        )
+
+
+def email_config() -> Tuple[str, str, str]:
+    """
+    Returns the recipient address and the sender's username and password, read
+    from the "recipient" and "sender" files on first use.
+    """
+    global _email_config
+    if _email_config is None:
+        with open(RECIPIENT_PATH) as recipient:
+            user_email = recipient.read().strip()
+        with open(SENDER_PATH) as sender:
+            sender_uname, sender_psswd = sender.read().strip().split("\n")
+        _email_config = (user_email, sender_uname, sender_psswd)
+    return _email_config
+
+
+def smtp_conn(uname: str, psswd: str) -> "SMTP":
+    """Returns the shared SMTP connection, opening and logging in if needed."""
+    from smtplib import SMTP_SSL as SMTP
+    import ssl
+
+    global _smtp_conn
+    if _smtp_conn is None:
+        conn = SMTP(
+            "smtp.gmail.com",
+            timeout=SMTP_TIMEOUT,
+            context=ssl.create_default_context(),
+        )
+        conn.login(uname, psswd)
+        _smtp_conn = conn
+        atexit.register(flush_email)
+    return _smtp_conn
+
+
+def flush_email() -> None:
+    """Closes the shared SMTP connection, if it's open."""
+    global _smtp_conn
+    if _smtp_conn is not None:
+        _smtp_conn.close()
+        _smtp_conn = None
 
 
 def main() -> None:
@@ -412,9 +1065,54 @@ def main() -> None:
         action="store_true",
         help="run experimental home directory cleanliness checker (config in code only)",
     )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help="most repositories to check at once",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="check every repository with git, and don't save results",
+    )
+    parser.add_argument(
+        "--ignore-untracked",
+        action="store_true",
+        help="only count changes to tracked files as dirty (faster)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=positive_int,
+        help=(
+            "keep running, checking every INTERVAL seconds (less often while "
+            "nothing changes); only new reports are emailed"
+        ),
+    )
     args = parser.parse_args()
 
-    checker(args.check_dir, REPORT_TRANSLATION[args.report_choice], args.check_home)
+    if args.interval is None:
+        checker(
+            args.check_dir,
+            REPORT_TRANSLATION[args.report_choice],
+            args.check_home,
+            args.jobs,
+            not args.no_cache,
+            not args.ignore_untracked,
+        )
+        return
+    try:
+        daemon_loop(
+            args.check_dir,
+            REPORT_TRANSLATION[args.report_choice],
+            args.check_home,
+            args.interval,
+            args.jobs,
+            not args.no_cache,
+            not args.ignore_untracked,
+        )
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":